@@ -4,7 +4,7 @@ import anndata as ad
 import pandas as pd
 import multianndata as md
 import torch
-from torch.utils.data import DataLoader
+from .training import dataloader
 from tqdm import tqdm
 pb = lambda x: tqdm(x, ncols=100)
 
@@ -37,17 +37,21 @@ def apply(model, P, embedding=None, batch_size=1000):
 	P.pytorch_mode()
 	P.augmentation_off()
 	model.eval()
-	eval_loader = DataLoader(
-		dataset=P,
-		batch_size=batch_size,
-		shuffle=False)
+	device = next(model.parameters()).device
+	eval_loader = dataloader(P, batch_size, device)
 
-	Z = []
+	# write each batch straight into one preallocated array instead of concatenating at the end
+	Z = None; offset = 0
 	with torch.no_grad():
-		for batch in pb(eval_loader):
-			Z.append(embedding(batch).detach().cpu().numpy())
-
-	return np.concatenate(Z)
+		for x, sids in pb(eval_loader):
+			batch = (x.to(device, non_blocking=True), sids.to(device, non_blocking=True))
+			z = embedding(batch).detach().cpu().numpy()
+			if Z is None:
+				Z = np.empty((len(P), *z.shape[1:]), dtype=z.dtype)
+			Z[offset:offset+len(z)] = z
+			offset += len(z)
+
+	return Z
 
 def latentrep(model, P, samplemeta, **kwargs):
 	apply(model, P)
@@ -11,7 +11,7 @@ pb = lambda x: tqdm(x, ncols=100)
 
 class ToTorch:
     def __call__(self, x):
-        return torch.tensor(x).permute(*range(x.ndim - 3), x.ndim-1, x.ndim-3, x.ndim-2)
+        return torch.tensor(x, device='cpu').permute(*range(x.ndim - 3), x.ndim-1, x.ndim-3, x.ndim-2)
 
 class RandomDiscreteRotation:
     def __call__(self, x):
@@ -86,4 +86,4 @@ class PatchCollection(Dataset):
         if self.dim_order == 'numpy':
             return patches, sid_nums
         else:
-            return self.transform(patches), torch.tensor(sid_nums)
\ No newline at end of file
+            return self.transform(patches), torch.tensor(sid_nums, device='cpu')
\ No newline at end of file
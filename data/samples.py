@@ -56,12 +56,29 @@ def choose_patches(samples, patchsize, patchstride, max_frac_empty=0.2):
     patch_meta['patchsize'] = patchsize
     return patch_meta
 
+# returns the row and column indices of every pixel in each patch, each of shape
+# (npatches, patchsize, patchsize), or None if the patches don't all have the same size
+def patch_pixels(patchmeta):
+    xs, ys, pss = patchmeta[['x','y','patchsize']].values.astype(int).T
+    if len(pss) == 0 or (pss != pss[0]).any():
+        return None
+    offsets = np.arange(pss[0])
+    shape = (len(pss), pss[0], pss[0])
+    rows = np.broadcast_to(ys[:,None,None] + offsets[None,:,None], shape)
+    cols = np.broadcast_to(xs[:,None,None] + offsets[None,None,:], shape)
+    return rows, cols
+
 def union_patches_in_sample(patchmeta, s):
     res = s[:,:,0].copy()
     res[:,:] = 0
 
-    for _, p in patchmeta[patchmeta.sid == s.sid].iterrows():
-        res[p.y:p.y+p.patchsize, p.x:p.x+p.patchsize] = 1
+    patchmeta = patchmeta[patchmeta.sid == s.sid]
+    pixels = patch_pixels(patchmeta)
+    if pixels is not None:
+        res.data[pixels] = 1
+    else:
+        for _, p in patchmeta.iterrows():
+            res[p.y:p.y+p.patchsize, p.x:p.x+p.patchsize] = 1
 
     return res
 
@@ -1,13 +1,23 @@
 import numpy as np
 import torch
 from torch import nn, Tensor
+from torch.nn.utils import skip_init
 from .vae import VAE
 
+# load_state_dict pre-hook that splits the weights of checkpoints saved with a single encoder_end layer
+def split_encoder_end(module, state_dict, prefix, *args):
+    if prefix + 'encoder_end.weight' in state_dict:
+        weight = state_dict.pop(prefix + 'encoder_end.weight')
+        nconv = module.proj_conv.in_features
+        state_dict[prefix + 'proj_conv.weight'] = weight[:, :nconv]
+        state_dict[prefix + 'proj_conv.bias'] = state_dict.pop(prefix + 'encoder_end.bias')
+        state_dict[prefix + 'proj_avg.weight'] = weight[:, nconv:]
+
 class SimpleVAE(VAE):
     """Simple convolutional variational autoencoder."""
 
     def __init__(self, ncolors : int, patch_size : int,
-            latent_dim: int=100, nfilters1: int=256, nfilters2: int=512):
+            latent_dim: int=100, nfilters1: int=256, nfilters2: int=512, compile: bool=False):
         super().__init__()
         self.latent_dim = latent_dim
         self.nfilters1 = nfilters1
@@ -20,7 +30,20 @@ class SimpleVAE(VAE):
             nn.ReLU(),
         )
         self.encoder_flatten = nn.Flatten()
-        self.encoder_end = nn.Linear((patch_size//4)*(patch_size//4)*self.nfilters2 + ncolors, latent_dim + latent_dim)
+        # a linear layer on [conv output, average profile], split in two to avoid concatenating them.
+        # weights are sliced from one full-size layer, and the halves skip their own random init,
+        # so the initialization and the rng stream are unchanged
+        nconv = (patch_size//4)*(patch_size//4)*self.nfilters2
+        encoder_end = nn.Linear(nconv + ncolors, latent_dim + latent_dim)
+        device = encoder_end.weight.device
+        self.proj_conv = skip_init(nn.Linear, nconv, latent_dim + latent_dim, device=device)
+        self.proj_avg = skip_init(nn.Linear, ncolors, latent_dim + latent_dim, bias=False, device=device)
+        with torch.no_grad():
+            self.proj_conv.weight.copy_(encoder_end.weight[:, :nconv])
+            self.proj_conv.bias.copy_(encoder_end.bias)
+            self.proj_avg.weight.copy_(encoder_end.weight[:, nconv:])
+        # lets checkpoints saved with a single encoder_end layer still load
+        self.register_load_state_dict_pre_hook(split_encoder_end)
         
         self.decoder = nn.Sequential(
             nn.Linear(latent_dim, (patch_size//4)*(patch_size//4)*self.nfilters2),
@@ -31,11 +54,15 @@ class SimpleVAE(VAE):
             nn.ConvTranspose2d(self.nfilters1, ncolors, kernel_size=3, stride=2, padding=1, output_padding=1),
         )
 
+        # compiles in place so that state_dict keys are unchanged
+        self.compiled = compile
+        if compile:
+            for m in [self.encoder, self.proj_conv, self.decoder]:
+                m.compile(mode='reduce-overhead', fullgraph=True)
+
     def encode(self, xs):
         x, sid_nums = xs
-        output = self.encoder_flatten(self.encoder(x))
-        avg_profile = x.mean(axis=(2,3))
-        output = self.encoder_end(torch.cat((output, avg_profile), dim=1))
+        output = self.proj_conv(self.encoder_flatten(self.encoder(x))) + self.proj_avg(x.mean(dim=(2,3)))
         mean, logvar = torch.split(output, self.latent_dim, dim=1)
         return mean, logvar
 
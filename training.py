@@ -1,18 +1,23 @@
 import numpy as np
 import torch
 from torch import nn, Tensor
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, default_collate
 from torch.optim.lr_scheduler import LRScheduler
 import torch.nn.functional as F
-import random, time, os
+import random, time
 import pandas as pd
-from tempfile import TemporaryDirectory
 import matplotlib.pyplot as plt
 from IPython import display
 from . import vis as tv
 from tqdm import tqdm
 pb = lambda x: tqdm(x, ncols=100)
 
+# patch size is fixed, so cudnn only needs to autotune each conv once
+torch.backends.cudnn.benchmark = True
+# allow tf32 tensor cores for fp32 convs and matmuls
+torch.backends.cudnn.allow_tf32 = True
+torch.set_float32_matmul_precision('high')
+
 def seed(seed=0, deterministic=True):
     torch.manual_seed(seed)
     np.random.seed(seed)
@@ -24,8 +29,7 @@ def seed(seed=0, deterministic=True):
 
 def reconstruction_loss(x_true, x_pred : Tensor, per_sample: bool=False):
     x_true, _ = x_true
-    sse = torch.sum((x_pred - x_true)**2, dim=(1,2,3))
-    sse /= (x_true.shape[1]*x_true.shape[2]*x_true.shape[3])
+    sse = F.mse_loss(x_pred, x_true, reduction='none').mean(dim=(1,2,3))
     
     if per_sample:
         return sse
@@ -33,11 +37,45 @@ def reconstruction_loss(x_true, x_pred : Tensor, per_sample: bool=False):
         return torch.mean(sse)
 
 def kl_loss(mean : Tensor, logvar : Tensor):
+    # reduce in fp32 even under autocast so that logvar.exp() can't overflow
+    mean, logvar = mean.float(), logvar.float()
     return -0.5 * torch.mean(
         torch.sum(1 + logvar - mean.pow(2) - logvar.exp(),
         dim=tuple(range(1, mean.dim()))))
         # dim=1)) 
 
+def vae_loss(x_true : Tensor, x_pred : Tensor, mean : Tensor, logvar : Tensor):
+    # kl_weight is applied by the caller so that changing it doesn't force a recompile
+    return reconstruction_loss((x_true, None), x_pred), kl_loss(mean, logvar)
+
+# compiled lazily on first use; fuses both losses into a few kernels
+compiled_vae_loss = torch.compile(vae_loss, fullgraph=True)
+
+def channels_last_collate(batch):
+    # done on the cpu so that the (pinned) copy to the gpu already lands in NHWC
+    x, sids = default_collate(batch)
+    return x.contiguous(memory_format=torch.channels_last), sids
+
+def dataloader(dataset : Dataset, batch_size : int, device : torch.device, shuffle : bool=False,
+        drop_last : bool=False, num_workers : int=0):
+    # batches are collated on the cpu and pinned so that the copy to the gpu can be asynchronous.
+    # workers must not touch cuda, so only use num_workers > 0 if the default device is the cpu
+    return DataLoader(
+        dataset=dataset,
+        batch_size=batch_size,
+        shuffle=shuffle,
+        drop_last=drop_last,
+        collate_fn=channels_last_collate,
+        pin_memory=device.type == 'cuda',
+        num_workers=num_workers,
+        generator=torch.Generator(device=torch.get_default_device()))
+
+def losses_to_host(pending : list):
+    # copies a list of (loss, rloss, vaeloss) device scalars to the host with a single sync
+    if len(pending) == 0:
+        return [], [], []
+    return torch.stack([l.float() for p in pending for l in p]).view(-1, 3).cpu().T.tolist()
+
 def per_batch_logging(model : nn.Module, batch_num : int, rlosses : list, vaelosses : list,
         kl_weight : float, log_interval : int, scheduler : LRScheduler, epoch_start_time : int):
     lr = scheduler.get_last_lr()[0]
@@ -55,72 +93,102 @@ def per_batch_logging(model : nn.Module, batch_num : int, rlosses : list, vaelos
 def train_one_epoch(model : nn.Module, train_dataset : Dataset,
         optimizer : torch.optim.Optimizer, scheduler : LRScheduler,
         batch_size : int, log_interval : int=20, kl_weight : float=1,
-        per_batch_logging=per_batch_logging):
+        per_batch_logging=per_batch_logging, amp_dtype='auto', num_workers : int=0):
+    # amp_dtype='auto' uses bf16 autocast on cuda and fp32 elsewhere; None always trains in fp32.
+    # fp16 needs loss scaling, bf16 does not
     model.train()
-    train_loader = DataLoader(
-        dataset=train_dataset,
-        batch_size=batch_size,
-        shuffle=True,
-        generator=torch.Generator(device=torch.get_default_device()))
+    device = next(model.parameters()).device
+    device_type = device.type
+    if amp_dtype == 'auto':
+        amp_dtype = torch.bfloat16 if device_type == 'cuda' else None
+    scaler = torch.amp.GradScaler(device_type, enabled=amp_dtype == torch.float16)
+    # a compiled model needs fixed batch shapes, so drop the last partial batch in that case only
+    train_loader = dataloader(train_dataset, batch_size, device, shuffle=True,
+        drop_last=getattr(model, 'compiled', False), num_workers=num_workers)
     print(f'#batches: {len(train_loader)}')
+    loss_fn = compiled_vae_loss if getattr(model, 'compiled', False) else vae_loss
 
     epoch_start_time = time.time()
     losses = []; vaelosses = []; rlosses = []
+    pending = [] # losses still on the device, copied over at each log point
     for n, batch in enumerate(train_loader):
         # Forward pass
         x, sids = batch
+        x = x.to(device, non_blocking=True)
+        sids = sids.to(device, non_blocking=True)
         noise = 0#0.2 * torch.randn(x.shape[0], x.shape[1]).unsqueeze(-1).unsqueeze(-1).expand(-1, -1, x.shape[2], x.shape[3])
-        predictions, mean, logvar = model.forward([x+noise, sids])
+        with torch.autocast(device_type, dtype=amp_dtype, enabled=amp_dtype is not None):
+            predictions, mean, logvar = model.forward([x+noise, sids])
 
-        rloss = reconstruction_loss(batch, predictions)
-        vaeloss = kl_weight * kl_loss(mean, logvar)
-        loss = vaeloss + rloss
+            rloss, kl = loss_fn(x, predictions, mean, logvar)
+            vaeloss = kl_weight * kl
+            loss = vaeloss + rloss
 
         # Backward pass
-        optimizer.zero_grad()
-        loss.backward()
-        torch.nn.utils.clip_grad_norm_(model.parameters(), 1)
-        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        scaler.scale(loss).backward()
+        scaler.unscale_(optimizer)
+        # the multi-tensor (foreach) norm only has cuda kernels
+        torch.nn.utils.clip_grad_norm_(model.parameters(), 1, foreach=device_type == 'cuda')
+        scaler.step(optimizer)
+        scaler.update()
 
         # Save info
-        losses.append(float(loss))
-        rlosses.append(float(rloss))
-        vaelosses.append(float(vaeloss))
+        pending.append((loss.detach(), rloss.detach(), vaeloss.detach()))
 
         # Log
         if n % log_interval == 0 and n > 0:
+            for l, new in zip([losses, rlosses, vaelosses], losses_to_host(pending)):
+                l.extend(new)
+            pending = []
             per_batch_logging(model, n, rlosses, vaelosses, kl_weight,
                 log_interval, scheduler, epoch_start_time)
+        elif n == 0:
+            # the first batch absorbs compilation/autotuning, so leave it out of the timing
+            epoch_start_time = time.time()
 
+    for l, new in zip([losses, rlosses, vaelosses], losses_to_host(pending)):
+        l.extend(new)
     return pd.DataFrame({'loss':losses, 'rloss':rlosses, 'vaeloss':vaelosses, 'kl_weight':kl_weight})
 
 def evaluate(model : nn.Module, eval_dataset : Dataset, batch_size : int=1000,
-        detailed : bool=False, subset=None, sample_from_latent=False, full_loss=True, kl_weight=None):
+        detailed : bool=False, subset=None, sample_from_latent=False, full_loss=True, kl_weight=None,
+        num_workers : int=0):
     if subset is not None:
         eval_dataset = torch.utils.data.Subset(eval_dataset, subset)
 
     model.eval()
-    eval_loader = DataLoader(
-        dataset=eval_dataset,
-        batch_size=batch_size,
-        shuffle=False)
+    device = next(model.parameters()).device
+    eval_loader = dataloader(eval_dataset, batch_size, device, num_workers=num_workers)
 
-    losses = []; embeddings = []
+    # results are copied into preallocated (pinned) host buffers without syncing after every batch
+    pin = device.type == 'cuda'
+    losses = torch.empty(len(eval_dataset), device='cpu', pin_memory=pin); embeddings = None
+    offset = 0
     with torch.no_grad():
-        for batch in pb(eval_loader):
+        for x, sids in pb(eval_loader):
+            batch = (x.to(device, non_blocking=True), sids.to(device, non_blocking=True))
             predictions, mean, logvar = model.forward(batch, sample_from_latent=sample_from_latent)
 
             loss = reconstruction_loss(batch, predictions, per_sample=True)
             if full_loss:
                 loss += kl_weight * kl_loss(mean, logvar)
 
-            losses.append(loss.detach().cpu().numpy())
-            if detailed: embeddings.append(mean.detach().cpu().numpy())
+            b = len(loss)
+            losses[offset:offset+b].copy_(loss.detach(), non_blocking=True)
+            if detailed:
+                if embeddings is None:
+                    embeddings = torch.empty((len(eval_dataset), *mean.shape[1:]), dtype=mean.dtype,
+                        device='cpu', pin_memory=pin)
+                embeddings[offset:offset+b].copy_(mean.detach(), non_blocking=True)
+            offset += b
+    if pin:
+        torch.cuda.synchronize(device)
 
     if detailed:
-        return np.concatenate(losses), np.concatenate(embeddings)
+        return losses.numpy(), embeddings.numpy()
     else:
-        return np.concatenate(losses).mean()
+        return losses.numpy().mean()
 
 def simple_per_epoch_logging(model, val_dataset, epoch, epoch_start_time, losses, losslog):
     print(f'end of epoch {epoch}: avg val loss = {losses.mean()}')
@@ -151,35 +219,40 @@ def full_training(model : nn.Module, train_dataset : Dataset,
         scheduler : LRScheduler, batch_size : int=128, n_epochs : int=10,
         kl_weight : float=1, kl_warmup : bool=False,
         per_epoch_logging=simple_per_epoch_logging,
-        per_batch_logging=per_batch_logging, per_epoch_kwargs={}):
+        per_batch_logging=per_batch_logging, per_epoch_kwargs={}, amp_dtype='auto',
+        num_workers : int=0):
+    # channels_last lets cudnn use its NHWC (tensor core) conv kernels
+    model = model.to(memory_format=torch.channels_last)
     best_val_loss = float('inf')
     losslogs = []
 
-    with TemporaryDirectory() as tempdir:
-        best_model_params_path = os.path.join(tempdir, "best_model_params.pt")
+    best_params = None
 
-        for epoch in range(1, n_epochs + 1):
-            epoch_start_time = time.time()
-            losslog = train_one_epoch(
-                model, train_dataset, optimizer, scheduler, batch_size, kl_weight=kl_weight if kl_warmup else kl_weight * min((epoch-0) / 5, 1),
-                per_batch_logging=per_batch_logging)
-            losses, _ = evaluate(model, val_dataset, full_loss=True, kl_weight=kl_weight,
-                detailed=True, subset=range(0, len(val_dataset), max(1, len(val_dataset)//2000)))
-            scheduler.step()
-
-            losslog['val_loss'] = np.nan
-            losslog.val_loss.values[-1] = losses.mean()
-            losslogs.append(losslog)
-            losslogs_sofar = pd.concat(losslogs, axis=0).reset_index(drop=True)
-
-            per_epoch_logging(model, val_dataset, epoch, epoch_start_time, losses,
-                losslogs_sofar, **per_epoch_kwargs)
-
-            if losses.mean() < best_val_loss:
-                best_val_loss = losses.mean()
-                torch.save(model.state_dict(), best_model_params_path)
-
-        model.load_state_dict(torch.load(best_model_params_path)) # load best model states
+    for epoch in range(1, n_epochs + 1):
+        epoch_start_time = time.time()
+        losslog = train_one_epoch(
+            model, train_dataset, optimizer, scheduler, batch_size, kl_weight=kl_weight if kl_warmup else kl_weight * min((epoch-0) / 5, 1),
+            per_batch_logging=per_batch_logging, amp_dtype=amp_dtype, num_workers=num_workers)
+        losses, _ = evaluate(model, val_dataset, full_loss=True, kl_weight=kl_weight,
+            detailed=True, subset=range(0, len(val_dataset), max(1, len(val_dataset)//2000)),
+            num_workers=num_workers)
+        scheduler.step()
+
+        losslog['val_loss'] = np.nan
+        if len(losslog) > 0:
+            losslog.loc[losslog.index[-1], 'val_loss'] = losses.mean()
+        losslogs.append(losslog)
+        losslogs_sofar = pd.concat(losslogs, axis=0, ignore_index=True)
+
+        per_epoch_logging(model, val_dataset, epoch, epoch_start_time, losses,
+            losslogs_sofar, **per_epoch_kwargs)
+
+        if losses.mean() < best_val_loss:
+            best_val_loss = losses.mean()
+            # keep a host-memory copy of the best parameters rather than writing them to disk
+            best_params = {k: v.detach().to('cpu', copy=True) for k, v in model.state_dict().items()}
+
+    model.load_state_dict(best_params) # load best model states
     return model, losslogs_sofar
 
 def train_test_split(P, breakdown=[0.8,0.2]):
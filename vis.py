@@ -1,6 +1,5 @@
 import matplotlib.pyplot as plt
 import numpy as np
-from minisom import MiniSom
 import scanpy as sc
 from sklearn.preprocessing import scale
 import cv2
@@ -11,7 +10,8 @@ import pandas as pd
 from .data import samples as tds
 
 def plot_with_reconstruction(model, examples, show=True, channels=[0,1,2], pmin=None, pmax=None, cmap='seismic'):
-    examples = (examples[0].permute(0,3,1,2), examples[1])
+    device = next(model.parameters()).device
+    examples = (examples[0].permute(0,3,1,2).to(device), examples[1].to(device))
     model.eval()
     with torch.no_grad():
         predictions, means, _ = model.forward(examples)
@@ -19,17 +19,18 @@ def plot_with_reconstruction(model, examples, show=True, channels=[0,1,2], pmin=
     predictions = predictions.permute(0,2,3,1).cpu().numpy()
     losses = np.mean((examples - predictions)**2, axis=(1,2,3))
 
-    fig = plt.figure(figsize=(32,len(channels)*4))
+    fig, axs = plt.subplots(2*len(channels), len(examples), figsize=(32,len(channels)*4),
+        sharex='all', sharey='all', squeeze=False)
     for j, channel in enumerate(channels):
         for i, (a, b) in enumerate(zip(predictions, examples)):
-            plt.subplot(2*len(channels), len(examples), len(examples)*(2*j) + i + 1)
-            plt.imshow(b[:,:,channel], vmin=pmin[channel], vmax=pmax[channel], cmap=cmap)
-            plt.axis('off')
+            ax = axs[2*j, i]
+            ax.imshow(b[:,:,channel], vmin=pmin[channel], vmax=pmax[channel], cmap=cmap)
+            ax.axis('off')
             if j == 0:
-                plt.text(20, 1, f'{losses[i]:.2f}', ha='center', va='bottom', fontsize=16)
-            plt.subplot(2*len(channels), len(examples), len(examples)*(2*j+1) + i + 1)
-            plt.imshow(a[:,:,channel], vmin=pmin[channel], vmax=pmax[channel], cmap=cmap)
-            plt.axis('off')
+                ax.text(20, 1, f'{losses[i]:.2f}', ha='center', va='bottom', fontsize=16)
+            ax = axs[2*j+1, i]
+            ax.imshow(a[:,:,channel], vmin=pmin[channel], vmax=pmax[channel], cmap=cmap)
+            ax.axis('off')
 
     if show:
         plt.tight_layout()
@@ -44,14 +45,15 @@ def plot_patches_separatechannels(examples, choose=None, vmax=10, vmin=None, cha
         vmax = [vmax] * len(channels)
         vmin = [vmin] * len(channels)
     
-    fig = plt.figure(figsize=(len(examples)*1.5, len(channels)*1.5))
+    fig, axs = plt.subplots(len(channels), len(examples), figsize=(len(examples)*1.5, len(channels)*1.5),
+        sharex='all', sharey='all', squeeze=False)
     for j, channel in enumerate(channels):
         for i, a in enumerate(examples):
-            plt.subplot(len(channels), len(examples), i + j*len(examples) + 1)
-            plt.imshow(a[:,:,channel], vmin=vmin[channel], vmax=vmax[channel], cmap='seismic')
-            plt.axis('off')
+            ax = axs[j, i]
+            ax.imshow(a[:,:,channel], vmin=vmin[channel], vmax=vmax[channel], cmap='seismic')
+            ax.axis('off')
             if channelnames is not None and i == 0:
-                plt.gca().text(-5, 20, channelnames[j], va='center', ha='right', rotation=90)
+                ax.text(-5, 20, channelnames[j], va='center', ha='right', rotation=90)
 
     plt.tight_layout()
     plt.show()
@@ -67,10 +69,11 @@ def apply_colormap(pieces, colormaps):
         reshape = True
     else:
         reshape = False
-    images = np.zeros((pieces.shape[0], pieces.shape[1], pieces.shape[2], 3))
-    for [channel, color, scaler] in colormaps:
-        images += (scaler(pieces[:,:,:,channel])[:,:,:,None] * np.array(color)[None,None,None,:])
-    images[images > 1] = 1
+    # (N,H,W,K) scaled channels times (K,3) colors, as a single matmul
+    scaled = np.stack([scaler(pieces[:,:,:,channel]) for [channel, _, scaler] in colormaps], axis=-1)
+    colors = np.array([color for [_, color, _] in colormaps], dtype=float)
+    images = scaled @ colors
+    np.minimum(images, 1, out=images)
 
     if reshape:
         images = images[0]
@@ -98,6 +101,32 @@ def plot_patches_overlaychannels(examples, colormaps, nx=5, ny=5, show=True, see
         plt.show()
     return ix
 
+# trains a self-organizing map with a gaussian neighborhood and asymptotically decaying
+# sigma and learning rate (same defaults as MiniSom). returns weights of shape (nx, ny, dim)
+def fast_som(data, nx, ny, n_iter=1000, sigma=1.5, learning_rate=0.5, seed=1):
+    # initialize along the top two principal components, as MiniSom.pca_weights_init does
+    pc_length, pc = np.linalg.eigh(np.cov(data, rowvar=False))
+    pc = pc[:, np.argsort(-pc_length)[:2]]
+    W = (np.linspace(-1, 1, nx)[:,None,None] * pc[:,0] +
+        np.linspace(-1, 1, ny)[None,:,None] * pc[:,1]).reshape(nx*ny, -1)
+    grid = np.stack(np.meshgrid(np.arange(nx), np.arange(ny), indexing='ij'), axis=-1).reshape(-1, 2)
+
+    # like MiniSom.train_random, cycle through the data in a shuffled order
+    rng = np.random.default_rng(seed)
+    for t, i in enumerate(rng.permutation(np.arange(n_iter) % len(data))):
+        x = data[i]
+        bmu = np.argmin(((W - x)**2).sum(axis=1))
+        decay = 1 / (1 + t / (n_iter/2))
+        h = np.exp(-((grid - grid[bmu])**2).sum(axis=1) / (2 * (sigma*decay)**2))
+        W += learning_rate * decay * h[:,None] * (x - W)
+
+    return W.reshape(nx, ny, -1)
+
+# returns the flat index of the best-matching unit of each observation
+def som_bmus(data, weights):
+    W = weights.reshape(-1, weights.shape[-1])
+    return np.argmin((W**2).sum(axis=1)[None,:] - 2 * data @ W.T, axis=1)
+
 # colormaps consists of tuples of the form [channel, color, scaler]
 def plot_patches_overlaychannels_som(examples, latent, colormaps, nx=5, ny=5, show=True, seed=None, scale_factor=1, spacing=None,
         subsamplefactor=None):
@@ -107,21 +136,19 @@ def plot_patches_overlaychannels_som(examples, latent, colormaps, nx=5, ny=5, sh
         examples = examples[ix]
         latent = latent[ix]
 
-    som = MiniSom(nx, ny, len(latent[0]),
-              neighborhood_function='gaussian', sigma=1.5,
-              random_seed=1)
     latent = scale(latent)
-    som.pca_weights_init(latent)
-    som.train_random(latent, 1000, verbose=False)
-    map = som.labels_map(latent, range(len(latent)))
+    weights = fast_som(latent, nx, ny, n_iter=1000, sigma=1.5, seed=1)
+    bmus = som_bmus(latent, weights)
+    boxes = np.split(np.argsort(bmus, kind='stable'), np.cumsum(np.bincount(bmus, minlength=nx*ny))[:-1])
     
     fig, axs = plt.subplots(nx, ny,
         figsize=(scale_factor*nx,scale_factor*ny))
-    for p, box in map.items():
-        box = list(box)
+    for u, box in enumerate(boxes):
+        if len(box) == 0:
+            continue
         c = np.random.choice(box, size=1)[0]
         image = apply_colormap(examples[c], colormaps)
-        ax = axs[p[0],p[1]]
+        ax = axs[np.unravel_index(u, (nx, ny))]
         ax.imshow(image)
     for ax in axs.flatten():
         ax.axis('off')
@@ -189,13 +216,14 @@ def plot_patches_overlaychannels_linsum(patches, latents, colormaps, nx=5, ny=5,
 def plot_patches_overlaychannels_sorted(examples, colormaps, labels=None, nx=5, ny=5, show=True):
     images = apply_colormap(examples, colormaps)
     
-    fig, axs = plt.subplots(nx, ny, figsize=(nx,ny))
+    fig, axs = plt.subplots(ny, nx, figsize=(nx,ny), sharex='all', sharey='all', squeeze=False)
     for i, a in enumerate(images[:nx*ny]):
-        plt.subplot(ny,nx,i+1)
-        plt.imshow(a)
+        ax = axs.flat[i]
+        ax.imshow(a)
         if labels is not None:
-            plt.text(2, 10, f'{labels[i]}', color='white')
-        plt.axis('off')
+            ax.text(2, 10, f'{labels[i]}', color='white')
+    for ax in axs.flat:
+        ax.axis('off')
     plt.tight_layout()
     if show:
         plt.show()
@@ -221,9 +249,8 @@ def diff_markers(patch_avgs, pos_set, neg_set, markernames, labels=['T','F'], nm
     if ax is None:
         ax = plt.gca()
 
-    marker_diffs = pd.DataFrame(index=markernames, columns=['diff'])
-    for m in markernames:
-        marker_diffs.loc[m, 'diff'] = patch_avgs.loc[pos_set, m].median() -  patch_avgs.loc[neg_set, m].median()
+    marker_diffs = pd.DataFrame({'diff':
+        patch_avgs.loc[pos_set, markernames].median() - patch_avgs.loc[neg_set, markernames].median()})
     
     if sort:
         marker_diffs = marker_diffs.sort_values(by='diff', ascending=ascending)
@@ -269,15 +296,19 @@ def spatialplot(samples, sortkey, allpatches, scores, rgbs=[[1.,0.,0.]],
             nonempty_cols = range(len(canvas[0]))
 
         ax.imshow(canvas[nonempty_rows][:,nonempty_cols], cmap='grey')
+        pixels = tds.patch_pixels(mypatches)
         for score, color in zip(scores, rgbs):
             sigcanvas = np.zeros((*canvas.shape, 4))
             sigcanvas[:,:,:3] = color
             
             score_ = score[mypatches.index].values / vmax
-            for (x,y,ps), s in zip(mypatches[['x','y','patchsize']].values, score_):
-                x,y,ps = int(x), int(y), int(ps)
-                sigcanvas[y:y+ps,x:x+ps,-1] += s
-            sigcanvas[sigcanvas > 1] = 1
+            if pixels is not None:
+                np.add.at(sigcanvas[:,:,-1], pixels, np.broadcast_to(score_[:,None,None], pixels[0].shape))
+            else:
+                for (x,y,ps), s in zip(mypatches[['x','y','patchsize']].values, score_):
+                    x,y,ps = int(x), int(y), int(ps)
+                    sigcanvas[y:y+ps,x:x+ps,-1] += s
+            np.minimum(sigcanvas, 1, out=sigcanvas)
             ax.imshow(sigcanvas[nonempty_rows][:,nonempty_cols])
 
         if highlights is not None: